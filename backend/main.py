@@ -1,79 +1,238 @@
 import requests
+import ast
+import functools
 import json
+import logging
+import math
+import orjson
 import re
-from flask import Flask, jsonify, request, render_template, send_file
+import operator
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, jsonify, request, render_template, send_file, make_response
+from flask.json.provider import DefaultJSONProvider
+
+logger = logging.getLogger("nilch.search")
 
 BRAVE_SEARCH_API_KEYS = [] # Add your keys (can have multiple)
 
 BRAVE_SEARCH_API_HEADERS = {
     "Accept": "application/json",
-    "Accept-Encoding": "gzip",
-    "X-Subscription-Token": "setme" # Set later by the calling function
 }
 
+# Full headers for each key, built once so requests don't copy or modify shared headers
+BRAVE_SEARCH_API_KEY_HEADERS = [
+    {**BRAVE_SEARCH_API_HEADERS, "X-Subscription-Token": key} for key in BRAVE_SEARCH_API_KEYS
+]
+
 WIKIPEDIA_API_HEADERS = {
     "User-Agent": "nilch/1.0 (jake.stbu@gmail.com)"
 }
 
-recent_searches = []
+# Seconds to wait on Brave/Wikipedia/Wiktionary before giving up, so a slow upstream can't tie up the server.
+# Connecting gets a much shorter timeout than waiting for the response, as failed connects are retried below.
+CONNECT_TIMEOUT = 1
+REQUEST_TIMEOUT = 5
+UPSTREAM_TIMEOUT = (CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+
+# Shared session so connections to Brave/Wikipedia/Wiktionary are kept alive and reused
+session = requests.Session()
+# Only failures to connect (including connect timeouts) are retried. Anything after the request is sent
+# (including a pooled connection the server already closed, slow reads and 429s with Retry-After) is left
+# to the caller. At worst a call takes 3 * CONNECT_TIMEOUT + REQUEST_TIMEOUT plus ~0.3s of backoff (~8.3s).
+session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                                      max_retries=Retry(total=2, connect=2, read=0, status=0, other=0,
+                                                        respect_retry_after_header=False, backoff_factor=0.1)))
+session.headers["Accept-Encoding"] = "gzip"
+
+# Runs upstream lookups which don't depend on the Brave results alongside the Brave search
+lookup_executor = ThreadPoolExecutor(max_workers=8)
+
+MAX_RECENT_SEARCHES = 20
+
+class SearchKey(NamedTuple):
+    query: str
+    safe_search: str
+    is_videos: bool
+    page: int
+
+# SearchKey -> results, least recently used first
+recent_searches = OrderedDict()
+recent_searches_lock = threading.Lock()
+
+# Set to eg. "redis://localhost:6379/0" to share recent searches between all worker processes.
+# The in-process cache above is used when this is None or Redis can't be reached.
+REDIS_URL = None
+REDIS_SEARCH_TTL = 300
+
+redis_client = None
+if (REDIS_URL != None):
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=1)
+
+def get_redis_search_key(key: SearchKey):
+    return "nilch:search:" + orjson.dumps(tuple(key)).decode()
+
+# Seconds to stop using Redis for after it fails, so an outage doesn't slow down every search
+REDIS_RETRY_DELAY = 30
+# time.monotonic() at which Redis can be tried again, 0 while it's working
+redis_down_until = 0
+
+def use_redis():
+    return redis_client != None and redis_down_until <= time.monotonic()
+
+def redis_failed():
+    global redis_down_until
+    # Only warn once per outage rather than on every search
+    if (redis_down_until == 0):
+        logger.warning("couldn't reach redis, using the local search cache", exc_info=True)
+    redis_down_until = time.monotonic() + REDIS_RETRY_DELAY
+
+def redis_succeeded():
+    global redis_down_until
+    if (redis_down_until != 0):
+        redis_down_until = 0
+        logger.info("redis is back, no longer using the local search cache")
+        # Searches cached locally during the outage don't expire, so drop them
+        with recent_searches_lock:
+            recent_searches.clear()
+
+MAX_CACHED_LOOKUPS = 512
+LOOKUP_TTL = 60 * 60
+FAILED_LOOKUP_TTL = 60
+
+# Wiktionary word / Wikipedia title -> (expiry time, infobox), least recently used first.
+# Failed lookups are stored as None for a shorter time so missing pages aren't re-requested every search.
+definition_lookups = OrderedDict()
+wikipedia_lookups = OrderedDict()
+cached_lookups_lock = threading.Lock()
+
+NOT_CACHED = object()
+
+# Returns NOT_CACHED if the key isn't cached or has expired, otherwise the infobox (which may be None)
+def get_cached_lookup(lookups, key):
+    with cached_lookups_lock:
+        entry = lookups.get(key)
+        if (entry == None):
+            return NOT_CACHED
+        if (entry[0] < time.monotonic()):
+            del lookups[key]
+            return NOT_CACHED
+        lookups.move_to_end(key)
+        return entry[1]
+
+# Returns infobox
+def add_cached_lookup(lookups, key, infobox):
+    ttl = LOOKUP_TTL if (infobox != None) else FAILED_LOOKUP_TTL
+    with cached_lookups_lock:
+        lookups[key] = (time.monotonic() + ttl, infobox)
+        lookups.move_to_end(key)
+        if (len(lookups) > MAX_CACHED_LOOKUPS):
+            lookups.popitem(last=False)
+    return infobox
 
 # Returns results
 def add_recent_search(query: str, safe_search: str, is_videos: str, page: int, results):
-    recent_searches.append({
-        "query": query,
-        "safe": safe_search,
-        "is_videos": is_videos,
-        "page": page,
-        "results": results
-    })
-    if (len(recent_searches) >= 20):
-        recent_searches.pop(0)
+    key = SearchKey(query, safe_search, is_videos, page)
+    if use_redis():
+        try:
+            redis_client.setex(get_redis_search_key(key), REDIS_SEARCH_TTL, orjson.dumps(results))
+        except redis.RedisError:
+            redis_failed()
+        else:
+            redis_succeeded()
+            return results
+    with recent_searches_lock:
+        recent_searches[key] = results
+        recent_searches.move_to_end(key)
+        if (len(recent_searches) > MAX_RECENT_SEARCHES):
+            recent_searches.popitem(last=False)
     return results
 
 # Returns None if not in cache, otherwise search results
 def check_for_recent_search(query: str, safe_search: str, is_videos: str, page: int):
-    criteria = {
-        "query": query,
-        "safe": safe_search,
-        "is_videos": is_videos,
-        "page": page
-    }
-    for search in recent_searches:
-        match = all(
-            search.get(key) == value 
-            for key, value in criteria.items() 
-            if key != "results"
-        )
-        if match:
-            return search.get("results")
-    return None
+    key = SearchKey(query, safe_search, is_videos, page)
+    if use_redis():
+        try:
+            results = redis_client.get(get_redis_search_key(key))
+        except redis.RedisError:
+            redis_failed()
+        else:
+            redis_succeeded()
+            return orjson.loads(results) if (results != None) else None
+    with recent_searches_lock:
+        if key not in recent_searches:
+            return None
+        recent_searches.move_to_end(key)
+        return recent_searches[key]
+
+# Seconds to leave a rate limited key alone if Brave doesn't say how long to wait
+DEFAULT_RATE_LIMIT_COOLDOWN = 60
+
+# API key -> time.monotonic() at which it can be used again after being rate limited
+brave_key_cooldowns = {}
+# Index of the key to try first, so requests are spread across all keys
+brave_next_key = 0
+brave_keys_lock = threading.Lock()
+
+# Returns the number of seconds until a rate limited key can be used again
+def get_rate_limit_cooldown(response):
+    retry_after = response.headers.get("Retry-After")
+    if (retry_after != None and retry_after.isdigit()):
+        return int(retry_after)
+    # Brave sends comma separated values for each of its rate limit windows (eg. per second, per month)
+    try:
+        remaining = [int(value) for value in response.headers["X-RateLimit-Remaining"].split(",")]
+        reset = [int(value) for value in response.headers["X-RateLimit-Reset"].split(",")]
+    except (KeyError, ValueError):
+        return DEFAULT_RATE_LIMIT_COOLDOWN
+    exhausted = [seconds for seconds, left in zip(reset, remaining) if left == 0]
+    return max(exhausted) if exhausted else DEFAULT_RATE_LIMIT_COOLDOWN
 
 def make_brave_request(url, params):
-    for key in BRAVE_SEARCH_API_KEYS:
-        headers = BRAVE_SEARCH_API_HEADERS
-        headers["X-Subscription-Token"] = key
+    global brave_next_key
+    key_count = len(BRAVE_SEARCH_API_KEYS)
+    first_key = brave_next_key
+    for i in range(key_count):
+        index = (first_key + i) % key_count
+        key = BRAVE_SEARCH_API_KEYS[index]
+        # Skip keys which are still rate limited rather than wasting a request on them
+        if (brave_key_cooldowns.get(key, 0) > time.monotonic()):
+            continue
         try:
-            response = requests.get(url, headers=BRAVE_SEARCH_API_HEADERS, params=params)
-            if response.status_code == 200:
-                return response
-        except RateLimitError:
+            response = session.get(url, headers=BRAVE_SEARCH_API_KEY_HEADERS[index], params=params, timeout=UPSTREAM_TIMEOUT)
+        except requests.RequestException:
             continue
+        if response.status_code == 200:
+            with brave_keys_lock:
+                brave_next_key = (index + 1) % key_count
+            return response
+        if response.status_code == 429:
+            with brave_keys_lock:
+                brave_key_cooldowns[key] = time.monotonic() + get_rate_limit_cooldown(response)
+    return None
 
 def get_web_results(query: str, safe_search: str, is_videos: str, page: int):
     recent = check_for_recent_search(query, safe_search, is_videos, page)
     if (recent != None):
-        print("returning from cache!")
+        logger.debug("cache hit q=%s page=%s", query, page)
         return recent
-    print("original search!")
+    logger.debug("cache miss q=%s page=%s", query, page)
     result_type = "videos" if is_videos else "web"
     url = "https://api.search.brave.com/res/v1/" + result_type + "/search"
     params = { "q": query, "safesearch": safe_search, "count": 10, "offset": page }
     response = make_brave_request(url, params)
     if response != None and response.status_code == 200:
         if (is_videos):
-            return add_recent_search(query, safe_search, is_videos, page, response.json()["results"])
+            return add_recent_search(query, safe_search, is_videos, page, orjson.loads(response.content)["results"])
         else:
-            return add_recent_search(query, safe_search, is_videos, page, response.json()["web"]["results"])
+            return add_recent_search(query, safe_search, is_videos, page, orjson.loads(response.content)["web"]["results"])
     return None
 
 def get_img_results(query: str, safe_search: str):
@@ -81,71 +240,198 @@ def get_img_results(query: str, safe_search: str):
     params = { "q": query, "safesearch" : safe_search }
     response = make_brave_request(url, params)
     if response != None and response.status_code == 200:
-        results = response.json()["results"]
-        return [{"url": result["url"], "img": result["thumbnail"]["src"]} for result in results]
+        # Results without a thumbnail can't be shown, so skip them
+        return [{"url": result["url"], "img": img}
+                for result in orjson.loads(response.content)["results"]
+                if (img := result.get("thumbnail", {}).get("src"))]
     return None
 
-def get_infobox(web_results, query):
-    # Check if the user is trying to get a maths equation done
-    expr_pattern = r'[+\-/*÷x()0-9.^ ]+'
-    maths_patterns = [
-        rf'^what is ({expr_pattern})$',
-        rf'^solve ({expr_pattern})$',
-        rf'^calc ({expr_pattern})$',
-        rf'^calculate ({expr_pattern})$',
-        rf'^({expr_pattern})$',
-        rf'^({expr_pattern})=$',
-    ]
-    for pattern in maths_patterns:
-        match = re.match(pattern, query, re.IGNORECASE)
+EXPR_PATTERN = r'[+\-/*÷x()0-9.^ ]+'
+MATHS_PATTERNS = [
+    re.compile(rf'^what is ({EXPR_PATTERN})$', re.IGNORECASE),
+    re.compile(rf'^solve ({EXPR_PATTERN})$', re.IGNORECASE),
+    re.compile(rf'^calc ({EXPR_PATTERN})$', re.IGNORECASE),
+    re.compile(rf'^calculate ({EXPR_PATTERN})$', re.IGNORECASE),
+    re.compile(rf'^({EXPR_PATTERN})$', re.IGNORECASE),
+    re.compile(rf'^({EXPR_PATTERN})=$', re.IGNORECASE),
+]
+DEFINITION_PATTERN0 = re.compile(r'^what does ([a-zA-Z]+) mean$', re.IGNORECASE)
+DEFINITION_PATTERN1 = re.compile(r'^define ([a-zA-Z]+)$', re.IGNORECASE)
+# Cheap checks which every maths or definition query passes, so other queries skip the patterns
+MATHS_PREFIXES = ("what is ", "solve ", "calc ", "calculate ")
+MATHS_START_CHARS = frozenset("0123456789(.+- ")
+DEFINITION_PREFIXES = ("define ", "what does ")
+
+# definition is the future returned by prefetch_definition, if the lookup was started early
+def get_infobox(web_results, query, definition=None):
+    q_low = query.lower()
+    if could_be_maths(q_low):
+        equ = match_maths(query)
+        if (equ != None):
+            return solve_maths(equ)
+    if q_low.startswith(DEFINITION_PREFIXES):
+        word = match_definition(query)
+        if (word != None):
+            return definition.result() if (definition != None) else get_definition(word)
+    return get_wikipedia_infobox(web_results)
+
+# Starts the Wiktionary lookup in the background if the query asks for a definition, returns None otherwise
+def prefetch_definition(query):
+    if (not query.lower().startswith(DEFINITION_PREFIXES)):
+        return None
+    word = match_definition(query)
+    if (word == None):
+        return None
+    return lookup_executor.submit(get_definition, word)
+
+# q_low is the lowercased query
+def could_be_maths(q_low):
+    return q_low[:1] in MATHS_START_CHARS or q_low.startswith(MATHS_PREFIXES) or q_low.endswith("=")
+
+# Returns None if the query isn't a maths equation, otherwise the equation
+def match_maths(query):
+    for pattern in MATHS_PATTERNS:
+        match = pattern.match(query)
         if match:
             equ = match.group(1).strip()
-            equ = equ.replace("x", "*").replace("÷", "/").replace("^", "**")
-            try:
-                return {"infotype": "calc", "equ": equ, "result": str(eval(equ))}
-            except Exception:
-                return None
-    # Check if the user is checking the definition of a word
-    def_match0 = re.match(r'^what does ([a-zA-Z]+) mean$', query, re.IGNORECASE)
-    def_match1 = re.match(r'^define ([a-zA-Z]+)$', query, re.IGNORECASE)
-    word = None
+            return equ.replace("x", "*").replace("÷", "/").replace("^", "**")
+    return None
+
+def solve_maths(equ):
+    try:
+        return {"infotype": "calc", "equ": equ, "result": str(evaluate_maths(equ))}
+    except Exception:
+        return None
+
+MATHS_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+# Largest integer (in bits) a calculation may produce, so huge numbers can't tie up the server
+MAX_RESULT_BITS = 4096
+
+# Evaluates a plain arithmetic expression without eval(), raising ValueError on anything else
+@functools.lru_cache(maxsize=1024)
+def evaluate_maths(equ):
+    return evaluate_maths_node(ast.parse(equ, mode="eval").body)
+
+def evaluate_maths_node(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return check_maths_size(node.value)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in MATHS_OPERATORS:
+        return MATHS_OPERATORS[type(node.op)](evaluate_maths_node(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in MATHS_OPERATORS:
+        left = evaluate_maths_node(node.left)
+        right = evaluate_maths_node(node.right)
+        # Powers have to be checked before working them out, as the result is roughly right * log2(left) bits
+        if (isinstance(node.op, ast.Pow) and abs(left) > 1 and right * math.log2(abs(left)) > MAX_RESULT_BITS):
+            raise ValueError("result too large")
+        return check_maths_size(MATHS_OPERATORS[type(node.op)](left, right))
+    raise ValueError("unsupported expression")
+
+def check_maths_size(value):
+    if (isinstance(value, int) and value.bit_length() > MAX_RESULT_BITS):
+        raise ValueError("result too large")
+    return value
+
+# Returns None if the user isn't checking the definition of a word, otherwise the word
+def match_definition(query):
+    def_match0 = DEFINITION_PATTERN0.match(query)
+    def_match1 = DEFINITION_PATTERN1.match(query)
     if (def_match0):
-        word = def_match0.group(1)
+        return def_match0.group(1)
     elif (def_match1):
-        word = def_match1.group(1)
-    if (word != None):
-        # it's a definition, return Wiktionary definition
-        url = "https://en.wiktionary.org/api/rest_v1/page/definition/" + word
-        response = requests.get(url, headers = WIKIPEDIA_API_HEADERS)
-        if response.status_code != 200:
-            return None
-        data = response.json()
-        definition = None
-        for d in data["en"][0]["definitions"]:
-            if d["definition"] != "":
-                definition = d["definition"]
-                break
-        return {"word": word,
-                "type": data["en"][0]["partOfSpeech"],
-                "definition": definition,
-                "url": "https://en.wiktionary.org/wiki/" + word,
-                "infotype": "definition"}
-    # If one of the first 3 results are a wikipedia article, return the first page of the article
-    for i in range(min(3, len(web_results))):
-        if "wikipedia.org" in web_results[i]["url"]:
-            formatted_title = web_results[i]["title"].split(" - Wikipedia")[0].replace(" ", "_")
-            url = "https://en.wikipedia.org/api/rest_v1/page/summary/" + formatted_title
-            response = requests.get(url, headers=WIKIPEDIA_API_HEADERS)
-            if response.status_code != 200:
-                return None
-            data = response.json()
-            return {"title": data["title"],
-                    "info": data["extract"],
-                    "url": data["content_urls"]["desktop"]["page"],
-                    "infotype": "wikipedia"}
+        return def_match1.group(1)
+    return None
+
+# Returns the Wiktionary definition of a word
+def get_definition(word):
+    cached = get_cached_lookup(definition_lookups, word)
+    if (cached is not NOT_CACHED):
+        return cached
+    url = "https://en.wiktionary.org/api/rest_v1/page/definition/" + word
+    try:
+        response = session.get(url, headers = WIKIPEDIA_API_HEADERS, timeout=UPSTREAM_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return add_cached_lookup(definition_lookups, word, None)
+    data = orjson.loads(response.content)
+    definition = None
+    for d in data["en"][0]["definitions"]:
+        if d["definition"] != "":
+            definition = d["definition"]
+            break
+    return add_cached_lookup(definition_lookups, word, {
+        "word": word,
+        "type": data["en"][0]["partOfSpeech"],
+        "definition": definition,
+        "url": "https://en.wiktionary.org/wiki/" + word,
+        "infotype": "definition"})
+
+def get_wikipedia_infobox(web_results):
+    # If one of the first 3 results are an English wikipedia article, return the first page of the article
+    for result in web_results[:3]:
+        formatted_title = get_wikipedia_title(result["url"])
+        if (formatted_title != None):
+            return get_wikipedia_summary(formatted_title)
     return None # No infobox
 
+# Summaries come from the English Wikipedia, so articles from other languages can't be looked up
+WIKIPEDIA_HOSTS = ("en.wikipedia.org", "en.m.wikipedia.org")
+
+# Returns None if the URL isn't an English wikipedia article, otherwise the article title escaped for use in a URL path
+@functools.lru_cache(maxsize=4096)
+def get_wikipedia_title(url):
+    parts = urllib.parse.urlsplit(url)
+    if (parts.netloc not in WIKIPEDIA_HOSTS or not parts.path.startswith("/wiki/")):
+        return None
+    return urllib.parse.quote(urllib.parse.unquote(parts.path.removeprefix("/wiki/")), safe="")
+
+def get_wikipedia_summary(formatted_title):
+    cached = get_cached_lookup(wikipedia_lookups, formatted_title)
+    if (cached is not NOT_CACHED):
+        return cached
+    url = "https://en.wikipedia.org/api/rest_v1/page/summary/" + formatted_title
+    try:
+        response = session.get(url, headers=WIKIPEDIA_API_HEADERS, timeout=UPSTREAM_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return add_cached_lookup(wikipedia_lookups, formatted_title, None)
+    data = orjson.loads(response.content)
+    return add_cached_lookup(wikipedia_lookups, formatted_title, {
+        "title": data["title"],
+        "info": data["extract"],
+        "url": data["content_urls"]["desktop"]["page"],
+        "infotype": "wikipedia"})
+
+# Serialises API responses with orjson, which is much faster than the stdlib json module
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Lets browsers and a reverse proxy/CDN reuse API responses for this many seconds
+API_CACHE_MAX_AGE = 300
+
+# The ETag is a hash of the response body, so a matching If-None-Match only saves sending the body again
+def cacheable_response(body):
+    response = make_response(body)
+    response.add_etag()
+    response.headers["Cache-Control"] = f"public, max-age={API_CACHE_MAX_AGE}, s-maxage={API_CACHE_MAX_AGE}"
+    return response.make_conditional(request)
 
 @app.route("/api/search")
 def results():
@@ -158,18 +444,20 @@ def results():
         return "noquery"
     if (safe_search == None):
         safe_search = "strict"
+    # Definitions only depend on the query, so fetch them while Brave is searching
+    definition = prefetch_definition(query) if (not videos) else None
     results = get_web_results(query, safe_search, videos, page)
     if (results == None):
         return "noresults"
     if (not videos):
-        infobox = get_infobox(results, query)
+        infobox = get_infobox(results, query, definition)
     else:
         infobox = None
     infobox = "null" if (infobox == None) else infobox
-    return {
+    return cacheable_response({
         "infobox": infobox,
         "results": results,
-    }
+    })
 
 @app.route("/api/images")
 def images():
@@ -182,7 +470,7 @@ def images():
     results = get_img_results(query, safe_search)
     if (results == None):
         return "noresults"
-    return results
+    return cacheable_response(results)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
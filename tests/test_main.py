@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+from unittest.mock import Mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+import main
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    monkeypatch.setattr(main, "recent_searches", OrderedDict())
+    monkeypatch.setattr(main, "definition_lookups", OrderedDict())
+    monkeypatch.setattr(main, "redis_client", None)
+
+
+def test_recent_search_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(main, "MAX_RECENT_SEARCHES", 2)
+    main.add_recent_search("q1", "strict", False, 0, ["r1"])
+    main.add_recent_search("q2", "strict", False, 0, ["r2"])
+    # Using q1 makes q2 the least recently used, so q2 is evicted rather than q1
+    assert main.check_for_recent_search("q1", "strict", False, 0) == ["r1"]
+    main.add_recent_search("q3", "strict", False, 0, ["r3"])
+    assert main.check_for_recent_search("q2", "strict", False, 0) is None
+    assert main.check_for_recent_search("q1", "strict", False, 0) == ["r1"]
+    assert main.check_for_recent_search("q3", "strict", False, 0) == ["r3"]
+
+
+def test_recent_search_key_includes_page():
+    main.add_recent_search("q", "strict", False, 0, ["page 0"])
+    assert main.check_for_recent_search("q", "strict", False, 1) is None
+
+
+def test_cached_lookup_expires(monkeypatch):
+    main.add_cached_lookup(main.definition_lookups, "cat", {"word": "cat"})
+    assert main.get_cached_lookup(main.definition_lookups, "cat") == {"word": "cat"}
+    now = time.monotonic()
+    monkeypatch.setattr(main.time, "monotonic", lambda: now + main.LOOKUP_TTL + 1)
+    assert main.get_cached_lookup(main.definition_lookups, "cat") is main.NOT_CACHED
+
+
+def test_failed_lookup_is_cached_as_none():
+    main.add_cached_lookup(main.definition_lookups, "qwxz", None)
+    assert main.get_cached_lookup(main.definition_lookups, "qwxz") is None
+
+
+@pytest.mark.parametrize("query,result", [
+    ("2+2", "4"),
+    ("what is (1+2)x3^2", "27"),
+    ("2^-1", "0.5"),
+])
+def test_solve_maths(query, result):
+    assert main.solve_maths(main.match_maths(query))["result"] == result
+
+
+@pytest.mark.parametrize("query", [
+    "2/0",
+    "9^9^9",
+    "((10^1000)^1000)^50",
+    "(2^4000)x(2^4000)x(2^4000)",
+])
+def test_solve_maths_rejects_invalid_or_huge(query):
+    assert main.solve_maths(main.match_maths(query)) is None
+
+
+@pytest.mark.parametrize("url,title", [
+    ("https://en.wikipedia.org/wiki/Cat", "Cat"),
+    ("https://en.m.wikipedia.org/wiki/AC/DC", "AC%2FDC"),
+    ("https://en.wikipedia.org/wiki/Caf%C3%A9#History", "Caf%C3%A9"),
+    ("https://fr.wikipedia.org/wiki/Chat", None),
+    ("https://notwikipedia.org/wiki/Foo", None),
+    ("https://example.com/wikipedia.org", None),
+])
+def test_get_wikipedia_title(url, title):
+    assert main.get_wikipedia_title(url) == title
+
+
+def test_brave_request_skips_rate_limited_key(monkeypatch):
+    monkeypatch.setattr(main, "BRAVE_SEARCH_API_KEYS", ["k1", "k2"])
+    monkeypatch.setattr(main, "BRAVE_SEARCH_API_KEY_HEADERS", [{"X-Subscription-Token": "k1"},
+                                                               {"X-Subscription-Token": "k2"}])
+    monkeypatch.setattr(main, "brave_key_cooldowns", {"k1": time.monotonic() + 60})
+    monkeypatch.setattr(main, "brave_next_key", 0)
+    get = Mock(return_value=Mock(status_code=200))
+    monkeypatch.setattr(main.session, "get", get)
+    assert main.make_brave_request("https://example.com", {}) is get.return_value
+    get.assert_called_once()
+    assert get.call_args.kwargs["headers"] == {"X-Subscription-Token": "k2"}
+    assert main.brave_next_key == 0
+
+
+def test_brave_request_puts_key_on_cooldown_after_429(monkeypatch):
+    monkeypatch.setattr(main, "BRAVE_SEARCH_API_KEYS", ["k1"])
+    monkeypatch.setattr(main, "BRAVE_SEARCH_API_KEY_HEADERS", [{"X-Subscription-Token": "k1"}])
+    monkeypatch.setattr(main, "brave_key_cooldowns", {})
+    monkeypatch.setattr(main, "brave_next_key", 0)
+    monkeypatch.setattr(main.session, "get", Mock(return_value=Mock(status_code=429, headers={"Retry-After": "30"})))
+    assert main.make_brave_request("https://example.com", {}) is None
+    assert main.brave_key_cooldowns["k1"] > time.monotonic() + 25